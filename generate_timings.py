@@ -1,7 +1,18 @@
+import Queue
+import argparse
+import errno
+import heapq
+import json
 import math
 import os
 import random
+import select
+import socket
 import sys
+import threading
+import time
+
+import render_audio
 
 # PLAYER FUNCTIONS
 #
@@ -73,6 +84,9 @@ def Beats(notes):
 # A Note Function is a function which takes a player step number and a player
 # number, and returns a list of notes.
 
+# Note Functions can return Runs (see below) in place of long stretches of the
+# same note, which the engine then handles in one go.
+
 # NOTE_LIST is a pre-defined Note Function which always returns the same list of
 # notes regardless of the step number or player number.
 def NOTE_LIST(*notes):
@@ -127,6 +141,29 @@ class ArbitraryNote(Note):
     self.beats = beats
     self.is_rest = is_rest
 
+# A Run is count repetitions of the same note, e.g. Run(Sixteenth(), 64) for a
+# bar of sixteenths or Run(Whole(REST), 8) for eight bars of rest.  It plays
+# exactly like count separate copies of the note.
+class Run(Note):
+  def __init__(self, note, count):
+    self.note = note
+    self.count = count
+
+  def GetBeats(self):
+    return self.note.GetBeats() * self.count
+
+  def IsRest(self):
+    return self.note.IsRest()
+
+# Returns (note, count) for a Run, or (note, 1) for any other note.  Runs of
+# runs are flattened, so Run(Run(Sixteenth(), 4), 4) gives 16 sixteenths.
+def Unrun(note):
+  count = 1
+  while isinstance(note, Run):
+    count *= note.count
+    note = note.note
+  return note, count
+
 # The following are pre-defined commonly used note durations.
 class Sixteenth(Note):
   def __init__(self, is_rest=False):
@@ -173,11 +210,17 @@ class Whole(Note):
 # Some pre-defined Tempo functions.  A tempo function is any function which
 # accepts a time-stamp which is relative to the beginning of the start of a
 # gesture, and returns a BPM.
+#
+# A tempo function which always returns the same BPM can say so by setting a
+# fixed_bpm attribute, and one which ignores the time-stamp by setting
+# beats_only.  Dry runs use these to avoid integrating the tempo, and runs of a
+# note with a fixed_bpm tempo only integrate the first note.
 
 # FIXED_TEMPO always returns the same BPM regardless of timestamp.
 def FIXED_TEMPO(bpm):
   def ReturnTempo(ts, beats):
     return bpm
+  ReturnTempo.fixed_bpm = bpm
   return ReturnTempo
 
 # TEMPO_RAMP ramps the tempo linearly from from_bpm to to_bpm over the course of
@@ -202,6 +245,7 @@ def TEMPO_RAMP_BEATS(from_bpm, to_bpm, duration):
 
     frac = beats / float(duration)
     return from_bpm * (1.0 - frac) + to_bpm * frac
+  ReturnTempo.beats_only = True
   return ReturnTempo
 
 # SINE_TEMPO creates a tempo which alternates between low and high BPM in a
@@ -214,8 +258,40 @@ def SINE_TEMPO(low, high):
   return ReturnTempo
 
 
+# TIME BASE
+#
+# By default times are floating point seconds built up by repeated addition.  A
+# piece (or --ticks-per-second) can instead set TICKS_PER_SECOND, e.g. to
+# 1000000 for microseconds or 44100 for audio sample frames.  Every time is then
+# snapped onto that grid and accumulated as an integer number of ticks, so the
+# same piece produces exactly the same timings on every run and platform.
+# Events carry their ticks as start_tick and stop_tick, and everything which
+# orders or exports events (the live scheduler, the HTML and the audio) works
+# from those integers rather than from the seconds.
+TICKS_PER_SECOND = None
+
+def SecondsToTicks(seconds):
+  return int(round(seconds * TICKS_PER_SECOND))
+
+def TicksToSeconds(ticks):
+  return ticks / float(TICKS_PER_SECOND)
+
+# Returns the timestamp ts advanced by seconds.  With a time base, both are
+# converted to ticks and added as integers.
+def AdvanceTime(ts, seconds):
+  if not TICKS_PER_SECOND:
+    return ts + seconds
+  return TicksToSeconds(SecondsToTicks(ts) + SecondsToTicks(seconds))
+
+# Returns the number of whole seconds needed to fit everything up until ts.
+def CeilSeconds(ts):
+  if not TICKS_PER_SECOND:
+    return int(math.ceil(ts))
+  return -(-SecondsToTicks(ts) // TICKS_PER_SECOND)
+
 # An Event is anything representing a player playing an instrument for a
-# duration.
+# duration.  With a time base, start_tick and stop_tick hold the exact integer
+# start and stop; otherwise they're None.
 class Event:
   def __init__(self, player_num, instrument, start, stop, is_rest):
     self.player_num = player_num
@@ -224,6 +300,27 @@ class Event:
     self.stop = stop
     self.is_rest = is_rest
 
+    if TICKS_PER_SECOND:
+      self.start_tick = SecondsToTicks(start)
+      self.stop_tick = SecondsToTicks(stop)
+    else:
+      self.start_tick = None
+      self.stop_tick = None
+
+  # Returns what to order events by: the start tick with a time base, otherwise
+  # the start in seconds.
+  def SortKey(self):
+    if self.start_tick is None:
+      return self.start
+    return self.start_tick
+
+  # Returns the start and stop of the event in whole milliseconds.
+  def Milliseconds(self):
+    if self.start_tick is None:
+      return int(self.start * 1000.0), int(self.stop * 1000.0)
+    return (self.start_tick * 1000 // TICKS_PER_SECOND,
+            self.stop_tick * 1000 // TICKS_PER_SECOND)
+
   def __str__(self):
     return "%d(%s) %.2f -> %.2f" % (self.player_num, self.instrument,
         self.start, self.stop)
@@ -284,25 +381,117 @@ class Gesture:
     return total_note_seconds
     
 
-  def _GenerateEventsForPlayer(self, player, notes, start_ts, start_beat, tempo_fn):
+  # Returns how many hundredths of a beat the notes are integrated over, using
+  # the same number of subdivisions for each note as _ComputeNoteDuration does.
+  def _CountSubdivisions(self, notes):
+    subdivisions = 0
+    for note in notes:
+      note, count = Unrun(note)
+      subdivisions += count * int(100 * note.GetBeats())
+    return subdivisions
+
+  # Returns how long, in seconds, notes spanning subdivisions hundredths of a
+  # beat take to play one after another, integrating the tempo over all of them
+  # in one go.  A fixed tempo isn't integrated at all.  When the tempo only
+  # depends on the beat and beat_times is given, the duration is read off
+  # beat_times instead, which holds how long it takes to reach each hundredth
+  # of a beat and is extended as needed.
+  def _ComputeSubdivisionsDuration(self, subdivisions, start_ts, start_beat,
+                                   tempo_fn, beat_times=None):
+    bpm = getattr(tempo_fn, "fixed_bpm", None)
+    if bpm is not None:
+      return subdivisions * 60.0 / bpm / 100.0
+
+    first = int(round(start_beat * 100))
+    if (beat_times is not None and getattr(tempo_fn, "beats_only", False) and
+        abs(first - start_beat * 100) < 1e-6):
+      last = first + subdivisions
+      total_seconds = beat_times[-1]
+      for subdivision in xrange(len(beat_times) - 1, last):
+        total_seconds += 60.0 / tempo_fn(0, subdivision / 100.0) / 100.0
+        beat_times.append(total_seconds)
+      return beat_times[last] - beat_times[first]
+
+    return self._IntegrateSubdivisions(subdivisions, start_ts, start_beat,
+                                       tempo_fn)
+
+  # Returns how long subdivisions hundredths of a beat take to play.
+  def _IntegrateSubdivisions(self, subdivisions, start_ts, start_beat,
+                             tempo_fn):
+    total_seconds = 0.0
+    for subdivision in xrange(subdivisions):
+      subdivision_tempo = tempo_fn(
+          start_ts + total_seconds,
+          start_beat + subdivision / 100.0)
+      total_seconds += 60.0 / subdivision_tempo / 100.0
+
+    return total_seconds
+
+  # Returns the stop times of count back to back repetitions of note, the first
+  # starting at start_ts.  The whole run is integrated in a single pass, with
+  # exactly the same arithmetic as calling _ComputeNoteDuration for each note.
+  # With a fixed_bpm tempo every note comes out the same, so only the first one
+  # is integrated.
+  def _ComputeRunStops(self, note, count, start_ts, start_beat, tempo_fn):
+    fixed = getattr(tempo_fn, "fixed_bpm", None) is not None
+    beats = note.GetBeats()
+    subdivide = 100 * beats
+    subdivision_beat_length = beats / float(subdivide)
+    beat_fractions = [beats * float(subdivision) / subdivide
+                      for subdivision in xrange(int(subdivide))]
+
+    stops = []
+    for i in xrange(count):
+      if i == 0 or not fixed:
+        total_note_seconds = 0.0
+        for beat_fraction in beat_fractions:
+          subdivision_tempo = tempo_fn(
+              start_ts + total_note_seconds,
+              start_beat + beat_fraction)
+          total_note_seconds += (60.0 / subdivision_tempo *
+                                 subdivision_beat_length)
+
+      start_ts = AdvanceTime(start_ts, total_note_seconds)
+      start_beat += beats
+      stops.append(start_ts)
+
+    return stops
+
+  # Returns the events for a player's notes, along with the time at which the
+  # last note stops.  Rests only advance the time unless emit_rests is set, in
+  # which case they're returned as events too.
+  def _GenerateEventsForPlayer(self, player, notes, start_ts, start_beat,
+                               tempo_fn, emit_rests=False):
     events = []
     for note in notes:
       sys.stdout.write('.')
       sys.stdout.flush()
 
-      note_duration = self._ComputeNoteDuration(note, start_ts, start_beat, tempo_fn)
+      note, count = Unrun(note)
+      is_rest = note.IsRest()
+      stops = self._ComputeRunStops(note, count, start_ts, start_beat, tempo_fn)
 
-      e = Event(player, "", start_ts, start_ts + note_duration, note.IsRest())
-      events.append(e)
+      if emit_rests or not is_rest:
+        for stop_ts in stops:
+          events.append(Event(player, "", start_ts, stop_ts, is_rest))
+          start_ts = stop_ts
+      elif stops:
+        start_ts = stops[-1]
 
-      start_ts += note_duration
-      start_beat += note.GetBeats()
+      start_beat += note.GetBeats() * count
 
-    return events
+    return events, start_ts
 
 
-  def Generate(self, num_players, steps, tempo_fn, start_ts):
-    events = []
+  # Generates the events for the gesture one step at a time, yielding
+  # (events, last_stop, latest_stop) for each step as soon as it has been
+  # computed: the step's events, when the last player's part stops and when the
+  # longest part stops.  This lets callers hand finished steps off to be
+  # written while later steps are generated.  Rests are only included as events
+  # when emit_rests is set.
+  def GenerateSteps(self, num_players, steps, tempo_fn, start_ts,
+                    emit_rests=False):
+    start_ts = AdvanceTime(start_ts, 0)
     start_beat = 0
 
     player_order = self.travel_function(num_players)
@@ -316,41 +505,95 @@ class Gesture:
         players = [players]
 
       # Generate events for all the players playing.
-      events_for_players = []
+      step_events = []
+      stops = []
       for player in players:
-        events_for_player = self._GenerateEventsForPlayer(
+        events_for_player, stop_ts = self._GenerateEventsForPlayer(
           player,
           self.notes(step, player),
           start_ts,
           start_beat,
-          tempo_fn)
+          tempo_fn,
+          emit_rests)
 
         # Tack on the instrument.
         for event in events_for_player:
           event.instrument = self.instrument
 
-        # Remember the events for this player.
-        events_for_players.append(events_for_player)
+        # Transfer over the generated events for this player into the list of
+        # events for this step, and remember when the player stopped.
+        step_events += events_for_player
+        stops.append(stop_ts)
 
       # Figure out which player played for the longest, and advance past the end
       # of that one.
-      durations = [Duration(x) for x in events_for_players]
+      durations = [stop_ts - start_ts for stop_ts in stops]
       max_index = durations.index(max(durations))
 
       # Advance our start timestamp and number of beats used.
-      start_ts += durations[max_index]
+      start_ts = AdvanceTime(start_ts, durations[max_index])
       start_beat += Beats(self.notes(step, max_index))
 
-      # Transfer over the generated events for each player into our list of all
-      # events.
-      for evp in events_for_players:
-        events += evp
+      start_ts = AdvanceTime(start_ts, self.time_between_players(
+          players[max_index], stops[max_index]))
 
-      start_ts += self.time_between_players(players[max_index],
-          events_for_players[max_index][-1].stop)
+      yield step_events, stops[-1], stops[max_index]
+
+  def Generate(self, num_players, steps, tempo_fn, start_ts,
+               emit_rests=False):
+    events = []
+    for step_events, _, _ in self.GenerateSteps(num_players, steps, tempo_fn,
+                                                start_ts, emit_rests):
+      events += step_events
 
     return events
 
+  # Works out where the gesture lands without generating any events, walking
+  # the steps just like GenerateSteps but computing each player's part of a
+  # step from its notes as a whole.  Returns (start, end, latest): the start of
+  # the first event, the stop of the last event, and the latest stop of any
+  # event.  Each part is integrated in one go rather than note by note, so
+  # these can differ slightly from a full render when the tempo depends on the
+  # beat or when there's a time base.
+  def Layout(self, num_players, steps, tempo_fn, start_ts):
+    start_ts = AdvanceTime(start_ts, 0)
+    gesture_start = start_ts
+    end = start_ts
+    latest = start_ts
+    start_beat = 0
+
+    player_order = self.travel_function(num_players)
+    beat_times = [0.0]
+
+    for step in xrange(steps):
+      players = player_order[step % len(player_order)]
+      if type(players) is not list and type(players) is not tuple:
+        players = [players]
+
+      # Every player in a step starts at the same time and beat, so parts of
+      # the same length only need working out once.
+      durations = []
+      step_durations = {}
+      for player in players:
+        subdivisions = self._CountSubdivisions(self.notes(step, player))
+        if subdivisions not in step_durations:
+          step_durations[subdivisions] = AdvanceTime(
+              start_ts, self._ComputeSubdivisionsDuration(
+                  subdivisions, start_ts, start_beat, tempo_fn,
+                  beat_times)) - start_ts
+        durations.append(step_durations[subdivisions])
+      max_index = durations.index(max(durations))
+
+      end = AdvanceTime(start_ts, durations[-1])
+      latest = max(latest, AdvanceTime(start_ts, durations[max_index]))
+
+      start_ts = AdvanceTime(start_ts, durations[max_index])
+      start_beat += Beats(self.notes(step, max_index))
+      start_ts = AdvanceTime(start_ts, self.time_between_players(
+          players[max_index], start_ts))
+
+    return gesture_start, end, latest
+
 
 # Visualization related functions.
 EDGE = 50
@@ -391,6 +634,270 @@ def Events2HTML(out, instruments, events):
 
     out.write(filled_div)
 
+# Templates used by HTMLSink.  The player and instrument dependent parts
+# of each div are filled in ahead of time, so only the timing dependent parts
+# are formatted per event.  SPAN_MARK_DIV matches Events2HTML byte for byte,
+# while COMPACT_SPAN_MARK_DIV drops the whitespace inside each div.
+SPAN_MARK_DIV = """
+<div class="span-mark"
+     start-ms="%d"
+     stop-ms="%d"
+     player="%s"
+     instrument="%s"
+     style="top: %spx; left:%dpx; width: %dpx; %s">
+     <p>%s</p>
+</div> """
+
+COMPACT_SPAN_MARK_DIV = (
+    '<div class="span-mark" start-ms="%d" stop-ms="%d" player="%s" '
+    'instrument="%s" style="top: %spx; left:%dpx; width: %dpx; %s">'
+    '<p>%s</p></div>\n')
+
+# Events2HTMLBulk writes the same divs as Events2HTML, through an HTMLSink.  See
+# HTMLSink for how it goes about it.
+def Events2HTMLBulk(out, instruments, events, batch_size=4096, compact=False):
+  sink = HTMLSink(out, instruments, compact, batch_size)
+  sink.Write(events)
+  sink.Flush()
+
+# SINKS
+#
+# A Sink is anything which accepts batches of events through Write(events) and
+# is told that no more events are coming through Close().  Rests are left out
+# of the events unless a sink sets wants_rests.  If the piece fails part way, a
+# sink's Abort() is called instead of Close(), when it has one.
+
+# HTMLSink writes events into the visualization file as the same divs as
+# Events2HTML.  For the whole run it keeps a dict of instrument ids (picking up
+# new instruments as they're added to instruments) and each player's position
+# and colour, so only the timing of each event is formatted per div.  Divs are
+# collected across calls to Write() and written batch_size at a time with a
+# single out.write().  With compact set the whitespace inside each div is
+# dropped, which makes the file much smaller but no longer identical to what
+# Events2HTML writes.
+class HTMLSink:
+  wants_rests = False
+
+  def __init__(self, out, instruments, compact=False, batch_size=4096):
+    self.out = out
+    self.instruments = instruments
+    self.batch_size = batch_size
+    if compact:
+      self.template = COMPACT_SPAN_MARK_DIV
+    else:
+      self.template = SPAN_MARK_DIV
+
+    self.instrument_ids = {}
+    self.known_instruments = 0
+    self.player_fragments = {}
+    self.divs = []
+
+  def Write(self, events):
+    if self.known_instruments < len(self.instruments):
+      self._AddInstruments()
+
+    template = self.template
+    divs = self.divs
+    for event in events:
+      if event.is_rest:
+        continue
+
+      if event.player_num not in self.player_fragments:
+        self._AddPlayer(event.player_num)
+      player, top, style = self.player_fragments[event.player_num]
+
+      if event.start_tick is None:
+        start_ms = event.start * 1000.0
+        stop_ms = event.stop * 1000.0
+        left = event.start * EDGE
+        width = (event.stop - event.start) * EDGE - 1
+      else:
+        start_ms, stop_ms = event.Milliseconds()
+        left = event.start_tick * EDGE // TICKS_PER_SECOND
+
+        # Truncate towards zero like %d does above, so a note shorter than a
+        # pixel gets a width of 0px rather than -1px.
+        width, remainder = divmod((event.stop_tick - event.start_tick) * EDGE,
+                                  TICKS_PER_SECOND)
+        if width or not remainder:
+          width -= 1
+
+      divs.append(template % (
+          start_ms,
+          stop_ms,
+          player,
+          self.instrument_ids[event.instrument],
+          top,
+          left,
+          width,
+          style,
+          event.instrument))
+
+      if len(divs) >= self.batch_size:
+        self.Flush()
+        divs = self.divs
+
+  # Writes out any divs which are still waiting for a full batch.
+  def Flush(self):
+    if self.divs:
+      self.out.write("".join(self.divs))
+      self.divs = []
+
+  def Close(self):
+    self.Flush()
+    self.out.flush()
+
+  def _AddInstruments(self):
+    # Like instruments.index(), the first occurrence of an instrument wins.
+    for i in xrange(self.known_instruments, len(self.instruments)):
+      if self.instruments[i] not in self.instrument_ids:
+        self.instrument_ids[self.instruments[i]] = "%d" % i
+    self.known_instruments = len(self.instruments)
+
+  def _AddPlayer(self, player_num):
+    self.player_fragments[player_num] = (
+        "%d" % player_num,
+        "%d" % ((2 + player_num) * (EDGE/2)),
+        "height: %dpx; background-color: #%02x%02x%02x;" % (
+            EDGE / 2 - 1,
+            colors[player_num][0],
+            colors[player_num][1],
+            colors[player_num][2]))
+
+# AudioSink files every note played into a render_audio.NoteStore, which
+# spools them to a temporary file bucketed by block, and once the piece is
+# complete renders them to a WAV file at path with render_audio.RenderStore.
+# Only a bounded buffer of notes and the blocks being rendered are ever held in
+# memory.  Nothing is rendered if the piece fails part way.
+class AudioSink:
+  wants_rests = False
+
+  def __init__(self, path, instruments, processes=None):
+    self.path = path
+    self.instruments = instruments
+    self.processes = processes
+    self.instrument_ids = {}
+    self.known_instruments = 0
+    self.store = None
+
+  def Write(self, events):
+    if self.known_instruments < len(self.instruments):
+      self._AddInstruments()
+
+    # The store is only created once the piece starts playing, since the piece
+    # itself may set TICKS_PER_SECOND.
+    if self.store is None:
+      self.store = self._NewStore()
+
+    for event in events:
+      if event.is_rest:
+        continue
+      instrument = self.instrument_ids[event.instrument]
+      if event.start_tick is None:
+        self.store.Add(event.start, event.stop, event.player_num, instrument)
+      else:
+        self.store.Add(event.start_tick, event.stop_tick, event.player_num,
+                       instrument)
+
+  def Close(self):
+    if self.store is None:
+      self.store = self._NewStore()
+    try:
+      render_audio.RenderStore(self.path, self.store, self.processes)
+    finally:
+      self.Abort()
+
+  def Abort(self):
+    if self.store is not None:
+      self.store.Remove()
+      self.store = None
+
+  def _NewStore(self):
+    return render_audio.NoteStore(
+        render_audio.BLOCK_SECONDS * render_audio.SAMPLE_RATE,
+        ticks_per_second=TICKS_PER_SECOND)
+
+  def _AddInstruments(self):
+    # Like instruments.index(), the first occurrence of an instrument wins.
+    for i in xrange(self.known_instruments, len(self.instruments)):
+      if self.instruments[i] not in self.instrument_ids:
+        self.instrument_ids[self.instruments[i]] = i
+    self.known_instruments = len(self.instruments)
+
+# A SinkPipeline hands batches of events to a writer thread which passes them on
+# to every sink, so that writing one batch overlaps with generating the next.
+# The queue between the two is bounded: once max_batches batches are waiting,
+# Put() blocks until the writer catches up.
+#
+# If a sink fails, the batch it failed on still goes to the other sinks, but
+# every later batch is dropped for all of them.  The first error is raised once,
+# by whichever of Put() or Close() comes next.
+class SinkPipeline:
+  def __init__(self, sinks, max_batches=64):
+    self.sinks = sinks
+    self.queue = Queue.Queue(max_batches)
+    self.error = None
+    self.error_raised = False
+    self.closed = False
+    self.thread = threading.Thread(target=self._Drain)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Put(self, events):
+    self._RaiseWriterError()
+    self.queue.put(events)
+
+  def WantsRests(self):
+    return any(getattr(sink, "wants_rests", False) for sink in self.sinks)
+
+  # Waits for every queued batch to be written, then closes the sinks.  Any
+  # error hit by the writer thread which Put() hasn't already raised is raised
+  # here.
+  #
+  # Set aborted when shutting down because the piece failed.  Sinks which have
+  # an Abort() method get that instead of Close(), and the writer thread's
+  # error isn't raised so that it doesn't hide the piece's own.
+  def Close(self, aborted=False):
+    if self.closed:
+      return
+    self.closed = True
+
+    self.queue.put(None)
+    self.thread.join()
+    for sink in self.sinks:
+      if aborted and hasattr(sink, "Abort"):
+        sink.Abort()
+      else:
+        sink.Close()
+
+    if not aborted:
+      self._RaiseWriterError()
+
+  def _Drain(self):
+    while True:
+      events = self.queue.get()
+      if events is None:
+        return
+
+      # After a failure keep emptying the queue so Put() never blocks forever.
+      if self.error:
+        continue
+
+      for sink in self.sinks:
+        try:
+          sink.Write(events)
+        except Exception:
+          if not self.error:
+            self.error = sys.exc_info()
+
+  # Raises the writer thread's error, but only the first time it's asked to.
+  # The error itself stays set so the writer keeps dropping batches.
+  def _RaiseWriterError(self):
+    if self.error and not self.error_raised:
+      self.error_raised = True
+      error = self.error
+      raise error[0], error[1], error[2]
+
 def TimeGrid(out, max_seconds):
   # The + 2 is to account for the +2 spacing that scoots all the player marks
   # down.
@@ -617,6 +1124,298 @@ setupOscillators();
 </html>
 """)
 
+# Fills in the timing entries of a gesture's gesture_infos entry, given the start
+# of its first event and the stop of its last.  With a time base the entries are
+# also recorded in ticks, and the ones in seconds are worked out from those.
+def SetGestureTimes(info, start, end):
+  if not TICKS_PER_SECOND:
+    duration = end - start
+    info["start_time"] = start
+    info["end_time"] = start + duration
+    info["duration"] = duration
+    return
+
+  info["start_tick"] = SecondsToTicks(start)
+  info["end_tick"] = SecondsToTicks(end)
+  info["duration_ticks"] = info["end_tick"] - info["start_tick"]
+  info["start_time"] = TicksToSeconds(info["start_tick"])
+  info["end_time"] = TicksToSeconds(info["end_tick"])
+  info["duration"] = TicksToSeconds(info["duration_ticks"])
+
+# Prints where every gesture play starts and ends, in order of start time.
+def PrintTimeline(out, gesture_infos, piece_length):
+  plays = sorted(gesture_infos.items(),
+                 key=lambda (play_id, info): (info["start_time"],
+                                              info["end_time"], play_id))
+  width = max([len("play_id")] + [len(play_id) for play_id, _ in plays])
+
+  out.write("%-*s %10s %10s %10s\n" % (width, "play_id", "start", "end",
+                                       "duration"))
+  for play_id, info in plays:
+    out.write("%-*s %10.3f %10.3f %10.3f\n" % (width, play_id,
+                                              info["start_time"],
+                                              info["end_time"],
+                                              info["duration"]))
+  out.write("Piece length: %ds\n" % piece_length)
+
+# LIVE MODE
+#
+# In live mode PLAY_GESTURE doesn't generate anything itself.  Instead each
+# gesture play is handed to a LiveScheduler, which generates steps only once
+# the wall-clock playhead comes within lookahead seconds of them and streams
+# each event to connected clients as it becomes due.
+
+# LiveGesturePlay stands in for a gesture's entry in gesture_infos while the
+# gesture is being generated incrementally.  "start_time" and "tempo" are known
+# straight away.  The end and duration are worked out with Gesture.Layout the
+# first time they're asked for, e.g. through WHEN_DONE_PLAYING, so placing
+# gestures relative to each other doesn't generate any events before playback
+# starts.  Like a dry run, they can differ very slightly from the generated
+# events when the tempo depends on the beat.
+class LiveGesturePlay(dict):
+  def __init__(self, gesture, start_time, player_steps, tempo):
+    self.gesture = gesture
+    self.player_steps = player_steps
+
+    dict.__init__(self)
+    start_time = AdvanceTime(start_time, 0)
+    self["start_time"] = start_time
+    self["tempo"] = tempo
+    if TICKS_PER_SECOND:
+      self["start_tick"] = SecondsToTicks(start_time)
+
+    self.steps = gesture.GenerateSteps(NUM_PLAYERS, player_steps, tempo,
+                                       start_time)
+    self.events = []
+    self.end = None
+    self.done = False
+
+    # No event from a step that hasn't been generated yet can start before
+    # this.
+    self.generated_until = start_time
+
+  def __missing__(self, key):
+    if key not in ("end_time", "duration", "end_tick", "duration_ticks"):
+      raise KeyError(key)
+    _, end, _ = self.gesture.Layout(NUM_PLAYERS, self.player_steps,
+                                    self["tempo"], self["start_time"])
+    SetGestureTimes(self, self["start_time"], end)
+    return dict.__getitem__(self, key)
+
+  # Generates steps until the next ungenerated step can't start before
+  # horizon, then returns every event generated since the last call.
+  def TakeEventsUntil(self, horizon):
+    while not self.done and self.generated_until <= horizon:
+      self._GenerateStep()
+
+    events = self.events
+    self.events = []
+    return events
+
+  def _GenerateStep(self):
+    try:
+      step = self.steps.next()
+    except StopIteration:
+      self.done = True
+
+      # Unless the piece already placed other gestures using the layout's end
+      # time, record the exact one.
+      if "end_time" not in self:
+        SetGestureTimes(self, self["start_time"], self.end)
+      return
+
+    events, self.end, latest_stop = step
+    self.events += events
+    self.generated_until = latest_stop
+
+# LiveServer accepts local clients and sends them events as JSON, one object per
+# line.  address is either "host:port" for TCP or a path for a Unix socket.
+#
+# Clients are never waited on: whatever a client's socket won't take straight
+# away is kept in a buffer for that client and sent as the socket drains.  A
+# client whose buffer grows past max_buffer bytes has stopped reading and is
+# dropped, so that it can't hold up the playhead for everyone else.
+class LiveServer:
+  def __init__(self, address, max_buffer=256 * 1024):
+    self.max_buffer = max_buffer
+    self.unix_path = None
+    if ":" in address:
+      host, port = address.rsplit(":", 1)
+      self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.socket.bind((host, int(port)))
+    else:
+      self.unix_path = address
+      if os.path.exists(address):
+        os.unlink(address)
+      self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.socket.bind(address)
+
+    self.socket.listen(5)
+    self.clients = []
+    self.buffers = {}
+
+  # Waits up to timeout seconds, accepting any clients which connect and
+  # sending buffered data to any clients which can take it meanwhile.
+  def Wait(self, timeout):
+    waiting = [client for client in self.clients if self.buffers[client]]
+    readable, writable, _ = select.select([self.socket], waiting, [],
+                                          max(0, timeout))
+    for client in writable:
+      self._SendBuffered(client)
+    if readable:
+      client, _ = self.socket.accept()
+      client.setblocking(False)
+      self.clients.append(client)
+      self.buffers[client] = ""
+
+  def Send(self, lines):
+    data = "".join(lines)
+    for client in list(self.clients):
+      self.buffers[client] += data
+      self._SendBuffered(client)
+
+  # Gives every client up to a second to take whatever is left in its buffer,
+  # then disconnects everyone.
+  def Close(self):
+    for client in self.clients:
+      try:
+        client.settimeout(1.0)
+        client.sendall(self.buffers[client])
+      except socket.error:
+        pass
+      client.close()
+    self.clients = []
+    self.buffers = {}
+
+    self.socket.close()
+    if self.unix_path:
+      os.unlink(self.unix_path)
+
+  def _SendBuffered(self, client):
+    data = self.buffers[client]
+    try:
+      while data:
+        data = data[client.send(data):]
+    except socket.error, e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        # The client went away.
+        self._Drop(client)
+        return
+
+    self.buffers[client] = data
+    if len(data) > self.max_buffer:
+      self._Drop(client)
+
+  def _Drop(self, client):
+    self.clients.remove(client)
+    del self.buffers[client]
+    client.close()
+
+# LiveScheduler plays every scheduled gesture against the wall clock.
+#
+# An underrun is an event which was generated after the previous pass of the
+# loop had already moved the playhead beyond its start, i.e. one which couldn't
+# be sent on time because generation fell behind.  The latency of an event is
+# how late, in seconds, it was actually sent.
+class LiveScheduler:
+  def __init__(self, server, instruments, lookahead=2.0, clock=time.time,
+               poll_interval=0.01):
+    self.server = server
+    self.instruments = instruments
+    self.lookahead = lookahead
+    self.clock = clock
+    self.poll_interval = poll_interval
+
+    self.plays = []
+    self.pending = []
+    self.sequence = 0
+
+    self.events_sent = 0
+    self.underruns = 0
+    self.total_latency = 0.0
+    self.max_latency = 0.0
+
+  def Schedule(self, gesture, start_time, player_steps, tempo):
+    play = LiveGesturePlay(gesture, start_time, player_steps, tempo)
+    self.plays.append(play)
+    return play
+
+  def Run(self, wait_for_client=False):
+    while wait_for_client and not self.server.clients:
+      self.server.Wait(self.poll_interval)
+
+    instrument_ids = {}
+    for i in xrange(len(self.instruments) - 1, -1, -1):
+      instrument_ids[self.instruments[i]] = i
+
+    start = self.clock()
+    previous_playhead = 0
+    while True:
+      playhead = self.clock() - start
+      self._Generate(playhead, previous_playhead)
+      self._SendDue(start, instrument_ids)
+      previous_playhead = playhead
+
+      if not self.pending and all(play.done for play in self.plays):
+        break
+
+      # Sleep until the next event is due, but wake up regularly to keep
+      # generating ahead of the playhead.
+      timeout = self.poll_interval
+      if self.pending:
+        timeout = min(timeout, self.pending[0][2].start - (self.clock() - start))
+      self.server.Wait(timeout)
+
+  def MeanLatency(self):
+    if not self.events_sent:
+      return 0.0
+    return self.total_latency / self.events_sent
+
+  def _Generate(self, playhead, previous_playhead):
+    horizon = playhead + self.lookahead
+    for play in self.plays:
+      for event in play.TakeEventsUntil(horizon):
+        if event.is_rest:
+          continue
+        if event.start < previous_playhead:
+          self.underruns += 1
+
+        # The sequence number keeps events which start together in the order
+        # they were generated.
+        heapq.heappush(self.pending, (event.SortKey(), self.sequence, event))
+        self.sequence += 1
+
+  def _SendDue(self, start, instrument_ids):
+    lines = []
+    now = self.clock() - start
+    while self.pending and self.pending[0][2].start <= now:
+      _, _, event = heapq.heappop(self.pending)
+
+      latency = now - event.start
+      self.events_sent += 1
+      self.total_latency += latency
+      self.max_latency = max(self.max_latency, latency)
+
+      start_ms, stop_ms = event.Milliseconds()
+      message = {
+          "player": event.player_num,
+          "instrument": instrument_ids[event.instrument],
+          "instrument_name": event.instrument,
+          "start_ms": start_ms,
+          "stop_ms": stop_ms,
+      }
+      if event.start_tick is not None:
+        message["start_tick"] = event.start_tick
+        message["stop_tick"] = event.stop_tick
+      lines.append(json.dumps(message) + "\n")
+
+    if lines:
+      self.server.Send(lines)
+
+live_scheduler = None
+dry_run = False
+
 # PUBLIC FUNCTIONS
 
 # WHEN_DONE_PLAYING returns the end time of the specified gesture.
@@ -674,10 +1473,11 @@ def ON_BEAT_OF_GESTURE(beat, play_id):
   # note, and offset it by the start of the actual played gesture.
   n = ArbitraryNote(beat)
   g = Gesture()
-  return gesture_infos[play_id]["start_time"] + g._ComputeNoteDuration(n, 0, 0, tempo_fn)
+  return AdvanceTime(gesture_infos[play_id]["start_time"],
+                     g._ComputeNoteDuration(n, 0, 0, tempo_fn))
 
 def PLAY_GESTURE(gesture, start_time, player_steps, tempo, play_id = ""):
-  global visualization_file
+  global sink_pipeline
   global all_instruments
   global piece_length
   global gesture_infos
@@ -694,46 +1494,125 @@ def PLAY_GESTURE(gesture, start_time, player_steps, tempo, play_id = ""):
   if not gesture.instrument in all_instruments:
     all_instruments.append(gesture.instrument)
 
-  # Generate the events.
-  events = gesture.Generate(
+  # In live mode the gesture is generated later, as the playhead approaches it.
+  if live_scheduler:
+    gesture_infos[play_id] = live_scheduler.Schedule(
+        gesture, start_time, player_steps, tempo)
+    return
+
+  # In a dry run only work out where the gesture lands.
+  if dry_run:
+    start, end, latest = gesture.Layout(
+        NUM_PLAYERS,
+        player_steps,
+        tempo,
+        start_time)
+    piece_length = max(piece_length, CeilSeconds(latest))
+
+    gesture_infos[play_id] = { }
+    SetGestureTimes(gesture_infos[play_id], start, end)
+    gesture_infos[play_id]["tempo"] = tempo
+    return
+
+  # Generate the events a step at a time, handing each step to the sinks as
+  # soon as it's ready.
+  end = None
+  for events, end, latest_stop in gesture.GenerateSteps(
       NUM_PLAYERS,
       player_steps,
       tempo,
-      start_time)
+      start_time,
+      sink_pipeline.WantsRests()):
+    if events:
+      sink_pipeline.Put(events)
+
+    # Update the duration of the piece.
+    piece_length = max(piece_length, CeilSeconds(latest_stop))
 
   # Keep track of various bits of information about the gesture.
   gesture_infos[play_id] = { }
-  gesture_infos[play_id]["start_time"] = events[0].start
-  gesture_infos[play_id]["end_time"] = events[0].start + Duration(events)
-  gesture_infos[play_id]["duration"] = Duration(events)
+  SetGestureTimes(gesture_infos[play_id], AdvanceTime(start_time, 0), end)
   gesture_infos[play_id]["tempo"] = tempo
 
-  # Write them to the HTML file.
-  Events2HTML(visualization_file, all_instruments, events)
-
-  # Update the duration of the piece.
-  for e in events:
-    piece_length = int(max(piece_length, math.ceil(e.stop)))
-
 if __name__ == "__main__":
-  # Check that the args make sense.
-  if len(sys.argv) != 2:
-    print "Usage: %s <input file>" % sys.argv[0]
-    sys.exit(1)
-
-  if not os.path.isfile(sys.argv[1]):
-    print "Unknown file: %s" % sys.argv[1]
+  parser = argparse.ArgumentParser(
+      description="Generates the timings of a piece and visualizes them as "
+                  "<input file name>.html.")
+  parser.add_argument("input_file")
+  parser.add_argument("--dry-run", action="store_true",
+      help="Only work out where each gesture lands and print a timeline, "
+           "without generating any events or writing any HTML.")
+  parser.add_argument("--live", metavar="ADDRESS",
+      help="Instead of writing HTML, play the piece in real time and stream "
+           "its events as JSON lines to clients connecting to ADDRESS, either "
+           "host:port or the path of a Unix socket.")
+  parser.add_argument("--lookahead", type=float, default=2.0,
+      help="In live mode, how many seconds ahead of the playhead to generate "
+           "events.")
+  parser.add_argument("--wait", action="store_true",
+      help="In live mode, wait for the first client before starting.")
+  parser.add_argument("--wav", metavar="PATH",
+      help="Also render the piece to a WAV file at PATH.  Requires numpy.")
+  parser.add_argument("--processes", type=int,
+      help="How many processes to render audio with.  Defaults to one per "
+           "CPU.")
+  parser.add_argument("--ticks-per-second", type=int,
+      help="Snap all times onto an integer grid of this many ticks per "
+           "second, e.g. 1000000 or 44100.  A piece can also set "
+           "TICKS_PER_SECOND itself.")
+  args = parser.parse_args()
+
+  if not os.path.isfile(args.input_file):
+    print "Unknown file: %s" % args.input_file
     sys.exit(1)
 
   # Prepare for executing the program.
-  piece_name = sys.argv[1].split(".")[0]
-  visualization_file = file("%s.html" % piece_name, "w")
-  HTMLHeader(visualization_file)
+  TICKS_PER_SECOND = args.ticks_per_second
   piece_length = 0
   all_instruments = []
   gesture_infos = {}
 
-  execfile(sys.argv[1])
+  if args.dry_run:
+    dry_run = True
+    execfile(args.input_file)
+    PrintTimeline(sys.stdout, gesture_infos, piece_length)
+    sys.exit(0)
+
+  if args.live:
+    live_scheduler = LiveScheduler(LiveServer(args.live), all_instruments,
+                                   args.lookahead)
+    try:
+      execfile(args.input_file)
+      live_scheduler.Run(args.wait)
+    finally:
+      live_scheduler.server.Close()
+
+    print "Sent %d events with %d underruns.  Latency: %.1fms mean, " \
+        "%.1fms max." % (live_scheduler.events_sent, live_scheduler.underruns,
+                          live_scheduler.MeanLatency() * 1000.0,
+                          live_scheduler.max_latency * 1000.0)
+    print "Done!"
+    sys.exit(0)
+
+  piece_name = args.input_file.split(".")[0]
+  visualization_file = file("%s.html" % piece_name, "w")
+  HTMLHeader(visualization_file)
+  sinks = [HTMLSink(visualization_file, all_instruments)]
+  if args.wav:
+    if render_audio.numpy is None:
+      print "Rendering to a WAV file requires numpy."
+      sys.exit(1)
+    sinks.append(AudioSink(args.wav, all_instruments, args.processes))
+  sink_pipeline = SinkPipeline(sinks)
+
+  try:
+    execfile(args.input_file)
+  except:
+    # Still make sure everything generated so far reaches the HTML file when
+    # the piece bails out part way, but don't render any audio.
+    sink_pipeline.Close(aborted=True)
+    raise
+  sink_pipeline.Close()
 
   TimeGrid(visualization_file, piece_length + 60)
   WritePlayers(NUM_PLAYERS, all_instruments, visualization_file)
@@ -0,0 +1,236 @@
+import collections
+import math
+import multiprocessing
+import os
+import struct
+import tempfile
+import wave
+
+# numpy is only needed for rendering audio, so the rest of the program still
+# works without it.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+SAMPLE_RATE = 44100
+
+# How many seconds of audio each worker renders at a time.  Only a handful of
+# blocks are ever in memory at once, however long the piece is.
+BLOCK_SECONDS = 10
+
+# Each note fades in and out over this many seconds to avoid clicks.
+FADE_SECONDS = 0.005
+
+# Each instrument gets its own voice, given as the relative strengths of the
+# harmonics of the player's frequency.  Instruments beyond the last voice wrap
+# around.
+VOICES = [
+    [1.0],                            # Sine.
+    [1.0, 0.0, 1 / 3.0, 0.0, 1 / 5.0, 0.0, 1 / 7.0],  # Square-ish.
+    [1.0, 1 / 2.0, 1 / 3.0, 1 / 4.0, 1 / 5.0],        # Sawtooth-ish.
+    [1.0, 0.0, 1 / 9.0, 0.0, 1 / 25.0],               # Triangle-ish.
+    [1.0, 0.5, 0.0, 0.25],                            # Organ-ish.
+]
+
+# Each player plays at the same frequency as its oscillator in the HTML player.
+def PlayerFrequency(player):
+  return 200 + player * 100
+
+# Converts a time to the nearest sample frame.  Times are in seconds, or in
+# integer ticks when ticks_per_second is given, in which case the conversion is
+# done exactly in integers.
+def TimeToFrame(time, sample_rate, ticks_per_second=None):
+  if not ticks_per_second:
+    return int(round(time * sample_rate))
+  return (2 * time * sample_rate + ticks_per_second) // (2 * ticks_per_second)
+
+# Each note is stored as its start and stop frames, player and instrument id.
+NOTE_FORMAT = struct.Struct("<qqii")
+
+# Reads back the notes a NoteStore wrote at chunks in the file at path.
+def ReadNotes(path, chunks):
+  notes = []
+  f = open(path, "rb")
+  try:
+    for offset, count in chunks:
+      f.seek(offset)
+      data = f.read(count * NOTE_FORMAT.size)
+      for i in xrange(count):
+        notes.append(NOTE_FORMAT.unpack_from(data, i * NOTE_FORMAT.size))
+  finally:
+    f.close()
+  return notes
+
+# A note is a (start, stop, player, instrument id) tuple, with times as taken by
+# TimeToFrame.  A NoteStore converts notes into sample frames as they are added
+# and files each one under every block it sounds in, so that a block's notes can
+# be read back on their own.  Rather than keeping every note in memory, the
+# store buffers up to max_buffered of them and then appends each block's buffer
+# to a temporary file, remembering the (offset, count) chunks it wrote for each
+# block.  Call Remove() to delete the file once done with the store.
+class NoteStore:
+  def __init__(self, block_frames, sample_rate=SAMPLE_RATE,
+               ticks_per_second=None, max_buffered=65536):
+    self.block_frames = block_frames
+    self.sample_rate = sample_rate
+    self.ticks_per_second = ticks_per_second
+    self.max_buffered = max_buffered
+
+    handle, self.path = tempfile.mkstemp(suffix=".notes")
+    self.file = os.fdopen(handle, "w+b")
+    self.buffers = collections.defaultdict(list)
+    self.buffered = 0
+    self.chunks = collections.defaultdict(list)
+
+    self.total_frames = 0
+    self.max_player = -1
+
+  def Add(self, start, stop, player, instrument):
+    start_frame = TimeToFrame(start, self.sample_rate, self.ticks_per_second)
+    stop_frame = TimeToFrame(stop, self.sample_rate, self.ticks_per_second)
+    self.total_frames = max(self.total_frames, stop_frame)
+    self.max_player = max(self.max_player, player)
+    if stop_frame <= start_frame:
+      return
+
+    record = NOTE_FORMAT.pack(start_frame, stop_frame, player, instrument)
+    for block in xrange(start_frame // self.block_frames,
+                        (stop_frame - 1) // self.block_frames + 1):
+      self.buffers[block].append(record)
+      self.buffered += 1
+    if self.buffered >= self.max_buffered:
+      self.Flush()
+
+  # Writes out every buffered note.
+  def Flush(self):
+    self.file.seek(0, os.SEEK_END)
+    for block, records in self.buffers.iteritems():
+      self.chunks[block].append((self.file.tell(), len(records)))
+      self.file.write("".join(records))
+    self.file.flush()
+    self.buffers.clear()
+    self.buffered = 0
+
+  # Returns the notes in block as a list of
+  # (start frame, stop frame, player, instrument id).
+  def Notes(self, block):
+    self.Flush()
+    return ReadNotes(self.path, self.chunks.get(block, []))
+
+  def Remove(self):
+    self.file.close()
+    os.unlink(self.path)
+
+# Renders a single block of audio, returning it as 16 bit little-endian samples.
+# This runs in the worker processes, so it takes a single tuple of
+# (block index, block frames, frames in this block, sample rate, gain, notes).
+def RenderBlock(job):
+  block, block_frames, frames, sample_rate, gain, notes = job
+
+  block_start = block * block_frames
+  fade_frames = max(1, int(FADE_SECONDS * sample_rate))
+  samples = numpy.zeros(frames)
+
+  for start_frame, stop_frame, player, instrument in notes:
+    first = max(start_frame, block_start)
+    last = min(stop_frame, block_start + frames)
+    if last <= first:
+      continue
+
+    # Use absolute frame numbers so that a note spanning several blocks stays
+    # in phase across them.
+    n = numpy.arange(first, last)
+    t = n / float(sample_rate)
+
+    voice = VOICES[instrument % len(VOICES)]
+    frequency = PlayerFrequency(player)
+    tone = numpy.zeros(last - first)
+    for harmonic, strength in enumerate(voice):
+      if strength:
+        tone += strength * numpy.sin(2 * math.pi * frequency * (harmonic + 1) *
+                                     t)
+    tone /= sum(voice)
+
+    envelope = numpy.minimum(1.0, numpy.minimum(n - start_frame,
+                                                stop_frame - n) /
+                                  float(fade_frames))
+    samples[first - block_start:last - block_start] += tone * envelope
+
+  samples = numpy.clip(samples * gain, -1.0, 1.0)
+  return (samples * 32767).astype("<i2").tostring()
+
+# Renders a block whose notes are still in a NoteStore's file, given a tuple of
+# (block index, block frames, frames in this block, sample rate, gain, path,
+# chunks).  The notes are read in the worker process, so only the blocks being
+# rendered are ever in memory.
+def RenderStoredBlock(job):
+  block, block_frames, frames, sample_rate, gain, path, chunks = job
+  return RenderBlock((block, block_frames, frames, sample_rate, gain,
+                      ReadNotes(path, chunks)))
+
+# Renders the notes in store to a mono 16 bit WAV file at path.  Blocks are
+# rendered by a pool of processes (one per CPU unless processes says otherwise)
+# and written out in order as they finish.
+def RenderStore(path, store, processes=None):
+  if numpy is None:
+    raise ImportError("Rendering audio requires numpy.")
+
+  store.Flush()
+  block_frames = store.block_frames
+  total_frames = store.total_frames
+  num_blocks = (total_frames + block_frames - 1) // block_frames
+
+  # Scale so that every player sounding at once doesn't clip.
+  gain = 1.0 / max(store.max_player + 1, 1)
+
+  def Jobs():
+    for block in xrange(num_blocks):
+      frames = min(block_frames, total_frames - block * block_frames)
+      yield (block, block_frames, frames, store.sample_rate, gain, store.path,
+             store.chunks.get(block, []))
+
+  out = wave.open(path, "wb")
+  out.setnchannels(1)
+  out.setsampwidth(2)
+  out.setframerate(store.sample_rate)
+
+  if processes == 1:
+    try:
+      for job in Jobs():
+        out.writeframes(RenderStoredBlock(job))
+    finally:
+      out.close()
+    return
+
+  pool = multiprocessing.Pool(processes)
+  try:
+    # Keep only a few blocks in flight per worker so memory stays bounded.
+    max_in_flight = 2 * (processes or multiprocessing.cpu_count())
+    in_flight = collections.deque()
+    for job in Jobs():
+      in_flight.append(pool.apply_async(RenderStoredBlock, (job,)))
+      if len(in_flight) >= max_in_flight:
+        out.writeframes(in_flight.popleft().get())
+    while in_flight:
+      out.writeframes(in_flight.popleft().get())
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    out.close()
+
+# Renders a list of notes to a WAV file at path, as RenderStore does.
+def RenderWav(path, notes, sample_rate=SAMPLE_RATE,
+              block_seconds=BLOCK_SECONDS, processes=None,
+              ticks_per_second=None):
+  store = NoteStore(int(block_seconds * sample_rate), sample_rate,
+                    ticks_per_second)
+  try:
+    for note in notes:
+      store.Add(*note)
+    RenderStore(path, store, processes)
+  finally:
+    store.Remove()
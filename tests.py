@@ -1,4 +1,14 @@
+import StringIO
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
 import unittest
+import wave
+import generate_timings
+import render_audio
 from generate_timings import *
 
 class TestTempos(unittest.TestCase):
@@ -41,5 +51,518 @@ class TestNoteDuration(unittest.TestCase):
     g = Gesture()
     self.assertAlmostEqual(0.24443937, g._ComputeNoteDuration(Whole(), 0, 0, TF))
 
+class TestRuns(unittest.TestCase):
+  def Times(self, events):
+    return [(e.player_num, e.start, e.stop, e.is_rest) for e in events]
+
+  def test_run_matches_repeated_notes(self):
+    tempo = TEMPO_RAMP_BEATS(70, 140, 12)
+    expanded = Gesture()
+    expanded.notes = NOTE_LIST(*([TripletEighth()] * 7 + [Quarter(REST)] * 3 +
+                                 [Sixteenth()]))
+    compressed = Gesture()
+    compressed.notes = NOTE_LIST(Run(TripletEighth(), 7), Run(Quarter(REST), 3),
+                                 Sixteenth())
+
+    for g in [expanded, compressed]:
+      self.assertAlmostEqual(Beats(g.notes(0, 0)), 16 / 3.0 + 0.25)
+
+    self.assertEqual(
+        self.Times(expanded.Generate(3, 4, tempo, 0.5, emit_rests=True)),
+        self.Times(compressed.Generate(3, 4, tempo, 0.5, emit_rests=True)))
+
+  def test_nested_runs(self):
+    tempo = TEMPO_RAMP_SECONDS(60, 120, 10)
+    expanded = Gesture()
+    expanded.notes = NOTE_LIST(*[Sixteenth()] * 16)
+    nested = Gesture()
+    nested.notes = NOTE_LIST(Run(Run(Sixteenth(), 4), 4))
+
+    self.assertEqual(Unrun(nested.notes(0, 0)[0])[1], 16)
+    self.assertEqual(self.Times(expanded.Generate(2, 3, tempo, 0)),
+                     self.Times(nested.Generate(2, 3, tempo, 0)))
+    self.assertEqual(nested.Layout(2, 3, tempo, 0),
+                     expanded.Layout(2, 3, tempo, 0))
+
+  def test_rests_advance_time_without_events(self):
+    g = Gesture()
+    g.notes = NOTE_LIST(Run(Quarter(REST), 2), Half(), Run(Whole(REST), 2))
+
+    steps = list(g.GenerateSteps(2, 2, FIXED_TEMPO(60), 0))
+    self.assertEqual([len(events) for events, _, _ in steps], [1, 1])
+    self.assertAlmostEqual(steps[0][0][0].start, 2)
+    self.assertAlmostEqual(steps[0][1], 12)
+    self.assertAlmostEqual(steps[0][2], 12)
+    self.assertAlmostEqual(steps[1][0][0].start, 14)
+    self.assertAlmostEqual(steps[1][1], 24)
+    self.assertAlmostEqual(steps[1][2], 24)
+
+    self.assertEqual(len(g.Generate(2, 2, FIXED_TEMPO(60), 0, True)), 10)
+
+  def test_fixed_tempo_run_integrates_once(self):
+    calls = []
+    def CountingFixedTempo(ts, beats):
+      calls.append(beats)
+      return 90
+    CountingFixedTempo.fixed_bpm = 90
+
+    g = Gesture()
+    g.notes = NOTE_LIST(Run(Sixteenth(), 64))
+    events = g.Generate(1, 1, CountingFixedTempo, 0)
+    self.assertEqual(len(calls), 25)
+    self.assertEqual(self.Times(events),
+                     self.Times(g.Generate(1, 1, FIXED_TEMPO(90), 0)))
+
+    # A tempo which isn't marked as fixed is integrated for every note.
+    del calls[:]
+    del CountingFixedTempo.fixed_bpm
+    self.assertEqual(self.Times(g.Generate(1, 1, CountingFixedTempo, 0)),
+                     self.Times(events))
+    self.assertEqual(len(calls), 64 * 25)
+
+  def test_layout_with_runs(self):
+    g = Gesture()
+    g.notes = NOTE_LIST(Run(Sixteenth(), 64), Run(Eighth(REST), 3))
+    g.travel_function = BOUNCE
+    tempo = TEMPO_RAMP_SECONDS(60, 120, 30)
+
+    steps = list(g.GenerateSteps(4, 5, tempo, 0))
+    start, end, latest = g.Layout(4, 5, tempo, 0)
+    self.assertEqual(start, 0)
+    self.assertAlmostEqual(end, steps[-1][1])
+    self.assertAlmostEqual(latest, max([latest for _, _, latest in steps]))
+
+class TestLayout(unittest.TestCase):
+  def setUp(self):
+    self.gesture = Gesture()
+    self.gesture.notes = NOTE_LIST(Quarter(), Eighth(REST), TripletEighth(),
+                                   Sixteenth())
+    self.gesture.travel_function = EXPLODE
+
+  def test_matches_generate(self):
+    for tempo in [FIXED_TEMPO(90), TEMPO_RAMP_SECONDS(60, 180, 5)]:
+      events = self.gesture.Generate(4, 6, tempo, 2.0)
+      start, end, latest = self.gesture.Layout(4, 6, tempo, 2.0)
+
+      self.assertAlmostEqual(start, events[0].start)
+      self.assertAlmostEqual(end, events[-1].stop)
+      self.assertAlmostEqual(latest, max([e.stop for e in events]))
+
+  def test_tempo_shortcuts(self):
+    calls = []
+    def CountingTempo(ts, beats):
+      calls.append(beats)
+      return 100 + beats
+
+    def CountingFixedTempo(ts, beats):
+      calls.append(beats)
+      return 90
+    CountingFixedTempo.fixed_bpm = 90
+
+    events = self.gesture.Generate(4, 6, FIXED_TEMPO(90), 2.0)
+    start, end, latest = self.gesture.Layout(4, 6, CountingFixedTempo, 2.0)
+    self.assertAlmostEqual(end, events[-1].stop)
+    self.assertAlmostEqual(latest, max([e.stop for e in events]))
+    self.assertEqual(calls, [])
+
+    # Player p plays p + 1 quarters.
+    g = Gesture()
+    g.notes = lambda step, player: [Quarter()] * (player + 1)
+    g.travel_function = EXPLODE
+
+    integrated = g.Layout(4, 6, CountingTempo, 2.0)
+    integrated_calls = len(calls)
+    del calls[:]
+    CountingTempo.beats_only = True
+    for expected, actual in zip(integrated,
+                                g.Layout(4, 6, CountingTempo, 2.0)):
+      self.assertAlmostEqual(expected, actual)
+
+    # Each hundredth of a beat up to the last one reached, beat 13, is only
+    # looked at once, rather than once for every different part that covers it.
+    self.assertEqual(len(calls), len(set(calls)))
+    self.assertEqual(len(calls), 1300)
+    self.assertEqual(integrated_calls, 2400)
+
+  def test_print_timeline(self):
+    infos = {
+        "b": {"start_time": 1.5, "end_time": 4.0, "duration": 2.5},
+        "a": {"start_time": 0, "end_time": 2.25, "duration": 2.25},
+    }
+    out = StringIO.StringIO()
+    PrintTimeline(out, infos, 4)
+    self.assertEqual(out.getvalue().splitlines(), [
+        "play_id      start        end   duration",
+        "a            0.000      2.250      2.250",
+        "b            1.500      4.000      2.500",
+        "Piece length: 4s",
+    ])
+
+class TestTimeBase(unittest.TestCase):
+  def setUp(self):
+    generate_timings.TICKS_PER_SECOND = 44100
+
+  def tearDown(self):
+    generate_timings.TICKS_PER_SECOND = None
+
+  def test_advance_time_snaps_to_ticks(self):
+    ts = 0
+    for i in xrange(3):
+      ts = AdvanceTime(ts, 1 / 3.0)
+    self.assertEqual(SecondsToTicks(ts), 44100)
+    self.assertEqual(ts, 1.0)
+
+  def test_generated_events_are_contiguous_ticks(self):
+    g = Gesture()
+    g.notes = NOTE_LIST(TripletEighth(), TripletEighth(), TripletEighth(REST))
+    events = g.Generate(3, 3, SINE_TEMPO(60, 90), 0.1, emit_rests=True)
+
+    self.assertEqual(events[0].start_tick, 4410)
+    for previous, event in zip(events, events[1:]):
+      self.assertEqual(previous.stop_tick, event.start_tick)
+      self.assertEqual(event.start, TicksToSeconds(event.start_tick))
+
+  def test_events_sort_on_ticks(self):
+    early = Event(0, "a", 1 / 3.0, 0.5, False)
+    late = Event(0, "a", 1 / 3.0 + 1e-9, 0.5, False)
+    self.assertEqual(early.SortKey(), 14700)
+    self.assertEqual(late.SortKey(), early.SortKey())
+
+    generate_timings.TICKS_PER_SECOND = None
+    self.assertEqual(Event(0, "a", 0.25, 0.5, False).SortKey(), 0.25)
+
+  def test_gesture_times(self):
+    info = {}
+    SetGestureTimes(info, 0.5, 1.75)
+    self.assertEqual(info["start_tick"], 22050)
+    self.assertEqual(info["end_tick"], 77175)
+    self.assertEqual(info["duration_ticks"], 55125)
+    self.assertEqual(info["duration"], 1.25)
+
+  def test_html_widths_match_float_mode(self):
+    def Events():
+      return [Event(0, "f", 0.3, stop, False)
+              for stop in [0.31, 0.32, 0.35, 0.3]]
+
+    with_ticks = StringIO.StringIO()
+    Events2HTMLBulk(with_ticks, ["f"], Events(), compact=True)
+
+    generate_timings.TICKS_PER_SECOND = None
+    without_ticks = StringIO.StringIO()
+    Events2HTMLBulk(without_ticks, ["f"], Events(), compact=True)
+
+    widths = re.findall("width: (-?[0-9]+)px", with_ticks.getvalue())
+    self.assertEqual(widths, ["0", "0", "1", "-1"])
+    self.assertEqual(widths,
+                     re.findall("width: (-?[0-9]+)px", without_ticks.getvalue()))
+
+  def test_html_uses_ticks(self):
+    out = StringIO.StringIO()
+    Events2HTMLBulk(out, ["flute"], [Event(2, "flute", 0.3, 0.7, False)],
+                    compact=True)
+    self.assertTrue('start-ms="300" stop-ms="700"' in out.getvalue())
+    self.assertTrue("left:15px; width: 19px;" in out.getvalue())
+
+class TestEvents2HTMLBulk(unittest.TestCase):
+  def setUp(self):
+    self.instruments = ["flute", "drum", "flute"]
+    self.events = [
+        Event(0, "flute", 0.0, 0.5, False),
+        Event(3, "drum", 0.25, 1.125, False),
+        Event(1, "drum", 1.0, 2.0, True),
+        Event(2, "flute", 1.33333, 2.66667, False),
+    ]
+
+  def test_matches_events2html(self):
+    expected = StringIO.StringIO()
+    Events2HTML(expected, self.instruments, self.events)
+
+    for batch_size in [1, 2, 4096]:
+      actual = StringIO.StringIO()
+      Events2HTMLBulk(actual, self.instruments, self.events, batch_size)
+      self.assertEqual(expected.getvalue(), actual.getvalue())
+
+  def test_html_sink_with_small_batches(self):
+    expected = StringIO.StringIO()
+    Events2HTML(expected, self.instruments, self.events)
+
+    # The sink sees "drum" only after some events have been written, just as
+    # instruments are added while a piece plays.
+    instruments = ["flute"]
+    actual = StringIO.StringIO()
+    sink = HTMLSink(actual, instruments, batch_size=2)
+    sink.Write(self.events[:1])
+    self.assertEqual(actual.getvalue(), "")
+
+    instruments += ["drum", "flute"]
+    for event in self.events[1:]:
+      sink.Write([event])
+    sink.Close()
+    self.assertEqual(expected.getvalue(), actual.getvalue())
+
+  def test_compact(self):
+    out = StringIO.StringIO()
+    Events2HTMLBulk(out, self.instruments, self.events, compact=True)
+    lines = out.getvalue().splitlines()
+
+    # The rest is skipped.
+    self.assertEqual(len(lines), 3)
+    self.assertTrue('start-ms="250" stop-ms="1125" player="3" '
+                    'instrument="1"' in lines[1])
+
+class TestSinkPipeline(unittest.TestCase):
+  class ListSink:
+    def __init__(self):
+      self.batches = []
+      self.closed = False
+
+    def Write(self, events):
+      self.batches.append(events)
+
+    def Close(self):
+      self.closed = True
+
+  class BrokenSink:
+    def __init__(self):
+      self.writes = 0
+      self.failed = threading.Event()
+
+    def Write(self, events):
+      self.writes += 1
+      self.failed.set()
+      raise IOError("write %d" % self.writes)
+
+    def Close(self):
+      pass
+
+  def test_batches_reach_every_sink_in_order(self):
+    sinks = [self.ListSink(), self.ListSink()]
+    pipeline = SinkPipeline(sinks, max_batches=1)
+    for i in xrange(10):
+      pipeline.Put([i])
+    pipeline.Close()
+
+    for sink in sinks:
+      self.assertEqual(sink.batches, [[i] for i in xrange(10)])
+      self.assertTrue(sink.closed)
+
+  def test_writer_error_is_raised(self):
+    pipeline = SinkPipeline([self.BrokenSink()])
+    pipeline.Put([1])
+    self.assertRaises(IOError, pipeline.Close)
+
+  def test_aborted_close(self):
+    class AbortableSink(self.ListSink):
+      aborted = False
+
+      def Abort(self):
+        self.aborted = True
+
+    plain = self.ListSink()
+    abortable = AbortableSink()
+    broken = self.BrokenSink()
+    pipeline = SinkPipeline([plain, abortable, broken])
+    pipeline.Put([1])
+
+    # The writer's error doesn't hide whatever caused the abort.
+    pipeline.Close(aborted=True)
+    self.assertTrue(plain.closed)
+    self.assertFalse(abortable.closed)
+    self.assertTrue(abortable.aborted)
+    self.assertEqual(abortable.batches, [[1]])
+
+  def test_writer_error_is_raised_once(self):
+    broken = self.BrokenSink()
+    working = self.ListSink()
+    pipeline = SinkPipeline([broken, working])
+    pipeline.Put([1])
+    broken.failed.wait(5)
+
+    try:
+      pipeline.Put([2])
+      self.fail("Put() should have raised")
+    except IOError, e:
+      self.assertEqual(str(e), "write 1")
+
+    # The error isn't raised again, and nothing more reaches either sink.
+    pipeline.Put([3])
+    pipeline.Close()
+    self.assertEqual(broken.writes, 1)
+    self.assertEqual(working.batches, [[1]])
+
+class TestLiveMode(unittest.TestCase):
+  class FakeServer:
+    def __init__(self, clock):
+      self.clock = clock
+      self.clients = []
+      self.lines = []
+
+    def Wait(self, timeout):
+      self.clock.now += max(timeout, 0.001)
+
+    def Send(self, lines):
+      self.lines += lines
+
+  class FakeClock:
+    def __init__(self):
+      self.now = 100.0
+
+    def __call__(self):
+      return self.now
+
+  def setUp(self):
+    generate_timings.NUM_PLAYERS = 2
+    self.gesture = Gesture()
+    self.gesture.notes = NOTE_LIST(Quarter(), Quarter(REST), Eighth())
+
+  def test_end_time_doesnt_generate(self):
+    play = LiveGesturePlay(self.gesture, 1.0, 3, FIXED_TEMPO(120))
+    self.assertEqual(play["start_time"], 1.0)
+
+    expected = self.gesture.Generate(2, 3, FIXED_TEMPO(120), 1.0)
+    self.assertAlmostEqual(play["end_time"], expected[-1].stop)
+    self.assertAlmostEqual(play["duration"], Duration(expected))
+    self.assertFalse(play.done)
+    self.assertEqual(play.TakeEventsUntil(0), [])
+
+    # Generating the gesture later doesn't move the end the piece was given.
+    end_time = play["end_time"]
+    self.assertEqual(len(play.TakeEventsUntil(100)), len(expected))
+    self.assertTrue(play.done)
+    self.assertEqual(play["end_time"], end_time)
+
+  def test_generates_only_within_lookahead(self):
+    play = LiveGesturePlay(self.gesture, 0, 4, FIXED_TEMPO(120))
+
+    # The first step's rest isn't an event.
+    self.assertEqual(len(play.TakeEventsUntil(0.5)), 2)
+    self.assertEqual(len(play.TakeEventsUntil(0.5)), 0)
+    self.assertFalse(play.done)
+
+  def test_run_streams_events_in_order(self):
+    clock = self.FakeClock()
+    server = self.FakeServer(clock)
+    scheduler = LiveScheduler(server, ["UNKNOWN INSTRUMENT"], lookahead=0.5,
+                              clock=clock)
+    scheduler.Schedule(self.gesture, 0, 2, FIXED_TEMPO(120))
+    scheduler.Schedule(self.gesture, 0.25, 1, FIXED_TEMPO(60))
+    scheduler.Run()
+
+    starts = [json.loads(line)["start_ms"] for line in server.lines]
+    self.assertEqual(starts, [0, 250, 1000, 1250, 2250, 2250])
+    self.assertEqual(scheduler.events_sent, 6)
+    self.assertEqual(scheduler.underruns, 0)
+    self.assertTrue(scheduler.max_latency < 0.011)
+
+  def test_run_orders_ticks(self):
+    generate_timings.TICKS_PER_SECOND = 1000
+    try:
+      clock = self.FakeClock()
+      server = self.FakeServer(clock)
+      scheduler = LiveScheduler(server, ["UNKNOWN INSTRUMENT"], lookahead=0.5,
+                                clock=clock)
+      scheduler.Schedule(self.gesture, 0, 2, FIXED_TEMPO(120))
+      scheduler.Schedule(self.gesture, 0.25, 1, FIXED_TEMPO(60))
+      scheduler.Run()
+    finally:
+      generate_timings.TICKS_PER_SECOND = None
+
+    starts = [json.loads(line)["start_tick"] for line in server.lines]
+    self.assertEqual(starts, [0, 250, 1000, 1250, 2250, 2250])
+
+class TestLiveServer(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "live.sock")
+    self.server = LiveServer(self.path, max_buffer=64 * 1024)
+
+  def tearDown(self):
+    self.server.Close()
+    os.rmdir(self.directory)
+
+  def Connect(self):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(self.path)
+    self.server.Wait(1)
+    return client
+
+  def test_stalled_client_is_dropped(self):
+    reader = self.Connect()
+    stalled = self.Connect()
+    self.assertEqual(len(self.server.clients), 2)
+
+    line = "x" * 1023 + "\n"
+    received = 0
+    for i in xrange(2048):
+      # Sending never blocks on the client which isn't reading.
+      self.server.Send([line])
+      reader.settimeout(1)
+      while received < (i + 1) * len(line):
+        received += len(reader.recv(65536))
+
+    self.assertEqual(len(self.server.clients), 1)
+    reader.close()
+    stalled.close()
+
+class TestRenderAudio(unittest.TestCase):
+  def test_note_store(self):
+    store = render_audio.NoteStore(10, 10, max_buffered=2)
+    try:
+      for note in [(0.0, 0.5, 0, 0), (0.75, 2.5, 1, 2), (3.0, 3.0, 0, 0),
+                   (0.25, 0.5, 2, 1)]:
+        store.Add(*note)
+
+      # The second note filled the buffer, so it has already been written out.
+      self.assertEqual(store.buffered, 1)
+      self.assertEqual(len(store.chunks[0]), 1)
+
+      self.assertEqual(store.Notes(0), [(0, 5, 0, 0), (8, 25, 1, 2),
+                                        (3, 5, 2, 1)])
+      self.assertEqual(store.Notes(1), [(8, 25, 1, 2)])
+      self.assertEqual(store.Notes(2), [(8, 25, 1, 2)])
+      self.assertEqual(store.Notes(3), [])
+      self.assertEqual(store.total_frames, 30)
+      self.assertEqual(store.max_player, 2)
+    finally:
+      store.Remove()
+    self.assertFalse(os.path.exists(store.path))
+
+  def test_note_store_in_ticks(self):
+    store = render_audio.NoteStore(100, 10, ticks_per_second=44100)
+    try:
+      store.Add(0, 441000, 0, 0)
+      store.Add(441001, 882000, 1, 1)
+      self.assertEqual(store.Notes(0), [(0, 100, 0, 0)])
+      self.assertEqual(store.Notes(1), [(100, 200, 1, 1)])
+    finally:
+      store.Remove()
+
+  def test_audio_sink_abort_removes_notes(self):
+    sink = AudioSink("unused.wav", ["a"])
+    sink.Write([Event(0, "a", 0.0, 0.5, False)])
+    path = sink.store.path
+    self.assertTrue(os.path.exists(path))
+    sink.Abort()
+    self.assertFalse(os.path.exists(path))
+
+  @unittest.skipIf(render_audio.numpy is None, "numpy is not installed")
+  def test_render_wav(self):
+    handle, path = tempfile.mkstemp(suffix=".wav")
+    os.close(handle)
+    try:
+      render_audio.RenderWav(path, [(0.0, 0.5, 0, 0), (0.25, 1.5, 1, 1)],
+                             sample_rate=8000, block_seconds=0.1, processes=1)
+      out = wave.open(path)
+      self.assertEqual(out.getframerate(), 8000)
+      self.assertEqual(out.getnframes(), 12000)
+      samples = render_audio.numpy.frombuffer(out.readframes(12000), "<i2")
+      out.close()
+
+      # Every note fades in from silence.
+      self.assertEqual(samples[0], 0)
+      self.assertTrue(abs(samples[:4000]).max() > 0)
+    finally:
+      os.unlink(path)
+
 if __name__ == "__main__":
   unittest.main()